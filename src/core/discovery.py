@@ -1,9 +1,24 @@
+import asyncio
+import concurrent.futures
+import heapq
 import socket
-import threading
 import time
 import logging
-from typing import Dict, Callable, Optional
-from .protocol import Message, MessageType, UDP_PORT, BROADCAST_IP, DISCOVERY_INTERVAL
+from typing import Dict, Callable, List, Optional, Set, Tuple
+from .eventloop import get_loop
+from .protocol import DiscoveryMsg, UDP_PORT, BROADCAST_IP, DISCOVERY_INTERVAL
+
+CLEANUP_INTERVAL = 5.0  # Seconds between stale peer sweeps
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, discovery: 'PeerDiscovery'):
+        self.discovery = discovery
+
+    def datagram_received(self, data: bytes, addr):
+        self.discovery._receive(data, addr)
+
+    def error_received(self, exc: Exception):
+        self.discovery.logger.error(f"Error in discovery socket: {exc}")
 
 class PeerDiscovery:
     def __init__(self, username: str, on_peer_discovered: Callable[[str, str], None], on_peer_lost: Callable[[str], None]):
@@ -13,84 +28,118 @@ class PeerDiscovery:
         self.running = False
         self.peers: Dict[str, float] = {}  # ip -> last_seen_timestamp
         self.peer_names: Dict[str, str] = {} # ip -> username
-        self.broadcast_socket: Optional[socket.socket] = None
-        self.listen_socket: Optional[socket.socket] = None
+        self._expiry_heap: List[Tuple[float, str]] = [] # (expiry_time, ip), one entry per known peer
+        # Peer state, the transport and the periodic tasks are only touched from the event
+        # loop thread, so no lock is needed
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []
+        self._discovery_bytes = b''
+        self._local_ips: Set[str] = set()
         self.logger = logging.getLogger("PeerDiscovery")
 
-    def start(self):
+    def start(self) -> concurrent.futures.Future:
+        # Called from UI threads, so don't wait on the loop (it calls back into the UI)
         self.running = True
-        
-        # Setup Broadcast Socket
-        self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # Setup Listen Socket
-        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            self.listen_socket.bind(('', UDP_PORT))
-        except OSError as e:
-            self.logger.error(f"Failed to bind UDP port {UDP_PORT}: {e}")
-            self.running = False
-            return
+        self._discovery_bytes = self._build_discovery_bytes()
+        self._local_ips = self._get_local_ips()
+        self._loop = get_loop()
+        future = asyncio.run_coroutine_threadsafe(self._open(), self._loop)
+        future.add_done_callback(self._on_started)
+        return future
 
-        # Start Threads
-        threading.Thread(target=self._broadcast_loop, daemon=True).start()
-        threading.Thread(target=self._listen_loop, daemon=True).start()
-        threading.Thread(target=self._cleanup_loop, daemon=True).start()
-        self.logger.info("Peer Discovery started.")
+    def _on_started(self, future: concurrent.futures.Future):
+        error = future.exception()
+        if error is None:
+            self.logger.info("Peer Discovery started.")
+        else:
+            self.logger.error(f"Failed to bind UDP port {UDP_PORT}: {error}")
+            self.running = False
 
     def stop(self):
         self.running = False
-        if self.broadcast_socket:
-            self.broadcast_socket.close()
-        if self.listen_socket:
-            self.listen_socket.close()
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._close)
         self.logger.info("Peer Discovery stopped.")
 
-    def _broadcast_loop(self):
+    async def _open(self):
+        # One socket both sends and receives the broadcasts
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', UDP_PORT))
+        except OSError:
+            sock.close()
+            raise
+        self.transport, _ = await self._loop.create_datagram_endpoint(lambda: _DiscoveryProtocol(self), sock=sock)
+        if not self.running:
+            # stop() ran while the endpoint was being created
+            self._close()
+            return
+        self._tasks = [
+            self._loop.create_task(self._broadcast_loop()),
+            self._loop.create_task(self._cleanup_loop()),
+        ]
+
+    def _close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    def set_username(self, username: str):
+        self.username = username
+        self._discovery_bytes = self._build_discovery_bytes()
+
+    def _build_discovery_bytes(self) -> bytes:
+        # The announcement never changes between broadcasts, so serialize it once.
+        # Receivers take the sender IP from the datagram address.
+        return DiscoveryMsg(self.username).to_bytes()
+
+    def _get_local_ips(self) -> Set[str]:
+        ips = {'127.0.0.1'}
+        try:
+            ips.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET))
+        except socket.gaierror:
+            pass
+        # The default-route interface is often missing from the hostname lookup (e.g. 127.0.1.1 on a Pi).
+        # Connecting a UDP socket sends nothing but makes the kernel pick that interface's address.
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                probe.connect(('10.255.255.255', 1))
+                ips.add(probe.getsockname()[0])
+        except OSError:
+            pass
+        return ips
+
+    async def _broadcast_loop(self):
         while self.running:
             try:
-                msg = Message(
-                    type=MessageType.DISCOVERY,
-                    sender_name=self.username,
-                    sender_ip="", # Receiver will determine IP
-                    payload={}
-                )
-                data = msg.to_bytes()
-                self.broadcast_socket.sendto(data, (BROADCAST_IP, UDP_PORT))
+                self.transport.sendto(self._discovery_bytes, (BROADCAST_IP, UDP_PORT))
             except Exception as e:
                 self.logger.error(f"Error broadcasting: {e}")
-            time.sleep(DISCOVERY_INTERVAL)
+            await asyncio.sleep(DISCOVERY_INTERVAL)
 
-    def _listen_loop(self):
+    async def _cleanup_loop(self):
         while self.running:
-            try:
-                data, addr = self.listen_socket.recvfrom(4096)
-                sender_ip = addr[0]
-                
-                # Ignore own broadcasts (simple check, can be improved)
-                # Ideally we check against local interfaces, but for now we rely on logic
-                
-                try:
-                    msg = Message.from_bytes(data)
-                    if msg.type == MessageType.DISCOVERY:
-                        self._handle_discovery(sender_ip, msg.sender_name)
-                except Exception as e:
-                    self.logger.error(f"Error parsing discovery message: {e}")
-
-            except OSError:
-                # Socket closed
-                break
-            except Exception as e:
-                self.logger.error(f"Error in listen loop: {e}")
+            await asyncio.sleep(CLEANUP_INTERVAL)
+            self._cleanup()
+
+    def _receive(self, data: bytes, addr):
+        try:
+            msg = DiscoveryMsg.from_bytes(data)
+            if msg is not None:
+                self._handle_discovery(addr[0], msg.sender_name)
+        except Exception as e:
+            self.logger.error(f"Error parsing discovery message: {e}")
 
     def _handle_discovery(self, ip: str, name: str):
-        # If we receive our own broadcast, we might want to filter it out.
-        # For simplicity, we'll assume the UI/Network manager handles "self" check 
-        # or we filter by checking if IP is one of ours. 
-        # For now, let's just register it.
+        # Our own broadcasts loop back to us; don't list ourselves as a peer
+        if ip in self._local_ips:
+            return
         
         current_time = time.time()
         is_new = ip not in self.peers
@@ -99,19 +148,26 @@ class PeerDiscovery:
         self.peer_names[ip] = name
         
         if is_new:
+            heapq.heappush(self._expiry_heap, (current_time + DISCOVERY_INTERVAL * 3, ip))
             self.on_peer_discovered(ip, name)
 
-    def _cleanup_loop(self):
-        while self.running:
-            time.sleep(5)
-            current_time = time.time()
-            to_remove = []
-            for ip, last_seen in self.peers.items():
-                if current_time - last_seen > (DISCOVERY_INTERVAL * 3):
-                    to_remove.append(ip)
-            
-            for ip in to_remove:
-                del self.peers[ip]
-                if ip in self.peer_names:
-                    del self.peer_names[ip]
-                self.on_peer_lost(ip)
+    def _cleanup(self):
+        # Only peers whose recorded expiry has passed are looked at. Entries are not
+        # updated on every broadcast, so a popped peer that was seen since is re-queued.
+        current_time = time.time()
+        heap = self._expiry_heap
+        while heap and heap[0][0] < current_time:
+            _, ip = heapq.heappop(heap)
+            last_seen = self.peers.get(ip)
+            if last_seen is None:
+                continue
+
+            expiry = last_seen + DISCOVERY_INTERVAL * 3
+            if expiry >= current_time:
+                heapq.heappush(heap, (expiry, ip))
+                continue
+
+            del self.peers[ip]
+            if ip in self.peer_names:
+                del self.peer_names[ip]
+            self.on_peer_lost(ip)
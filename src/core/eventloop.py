@@ -0,0 +1,15 @@
+import asyncio
+import threading
+from typing import Optional
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    # One background event loop serves discovery and all TCP connections
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="network-loop", daemon=True).start()
+        return _loop
@@ -1,109 +1,234 @@
+import asyncio
+import concurrent.futures
 import socket
-import threading
+import sys
 import json
 import os
 import logging
-from typing import Callable, Optional
-from .protocol import Message, MessageType, TCP_PORT, BUFFER_SIZE
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from .eventloop import get_loop
+from .protocol import (
+    Message, MessageType, TCP_PORT, STREAM_BUFFER_SIZE, SOCKET_BUFFER_SIZE, DOWNLOAD_DIR, CONNECT_TIMEOUT,
+    HEADER, FRAME_JSON, FRAME_FILE_DATA, MAX_FRAME_SIZE, MAX_MESSAGE_SIZE
+)
+
+# Selector transports gained a scatter-gather (sendmsg) writelines in Python 3.12
+_GATHER_WRITES = sys.version_info >= (3, 12)
+PROGRESS_STEP = 1024 * 1024  # Received bytes between on_file_progress calls
 
 class NetworkManager:
-    def __init__(self, username: str, on_message: Callable[[Message], None], on_file_progress: Callable[[str, int, int], None] = None):
+    def __init__(self, username: str, on_message: Callable[[Message], None], on_file_progress: Callable[[str, int, int], None] = None, download_dir: str = DOWNLOAD_DIR):
         self.username = username
         self.on_message = on_message
         self.on_file_progress = on_file_progress
         self.running = False
-        self.server_socket: Optional[socket.socket] = None
+        self.server: Optional[asyncio.AbstractServer] = None
         self.logger = logging.getLogger("NetworkManager")
-        self.active_transfers = {} # file_id -> file_handle
+        self.download_dir = download_dir
+        self.active_transfers = {} # connection addr -> (file_handle, filename, filesize, bytes_received)
+        self.pending_offers: Dict[tuple, str] = {} # (ip, filename) -> filepath offered to that peer
+        self.accepted_offers: Dict[tuple, int] = {} # (ip, filename) we agreed to receive -> offered filesize
+        # Everything below is only touched from the event loop thread
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._conns: Dict[str, Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = {} # ip -> persistent outgoing connection
+        self._conn_locks: Dict[str, asyncio.Lock] = {} # ip -> lock serialising connect/send to that peer
+        self._clients = set() # writers of accepted connections
+        self._tasks = set() # background tasks, referenced so they aren't garbage-collected mid-run
+        # Message types consumed here; anything else is handed to on_message
+        self._handlers: Dict[MessageType, Callable[[Message, tuple], Awaitable[None]]] = {
+            MessageType.FILE_DATA: self._handle_file_data,
+            MessageType.FILE_END: self._handle_file_end,
+            MessageType.FILE_ACCEPT: self._handle_file_accept,
+            MessageType.FILE_REJECT: self._handle_file_reject,
+        }
+
+    # Public methods are called from UI threads and never wait on the event loop: the loop
+    # thread delivers callbacks into those same UIs, so blocking here could deadlock.
+    # They return a concurrent.futures.Future; failures are logged and set on it.
 
-    def start(self):
+    def start(self) -> concurrent.futures.Future:
         self.running = True
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            self.server_socket.bind(('', TCP_PORT))
-            self.server_socket.listen(5)
-            threading.Thread(target=self._accept_loop, daemon=True).start()
+        future = self._submit(self._serve())
+        future.add_done_callback(self._on_started)
+        return future
+
+    def _on_started(self, future: concurrent.futures.Future):
+        error = future.exception()
+        if error is None:
             self.logger.info(f"TCP Server started on port {TCP_PORT}")
-        except OSError as e:
-            self.logger.error(f"Failed to bind TCP port {TCP_PORT}: {e}")
+        else:
+            self.logger.error(f"Failed to bind TCP port {TCP_PORT}: {error}")
             self.running = False
 
-    def stop(self):
+    def stop(self) -> concurrent.futures.Future:
         self.running = False
-        if self.server_socket:
-            self.server_socket.close()
+        future = self._submit(self._shutdown())
         self.logger.info("TCP Server stopped.")
+        return future
 
-    def _accept_loop(self):
-        while self.running:
-            try:
-                client_sock, addr = self.server_socket.accept()
-                threading.Thread(target=self._handle_client, args=(client_sock, addr), daemon=True).start()
-            except OSError:
-                break
-            except Exception as e:
-                self.logger.error(f"Error accepting connection: {e}")
-
-    def _handle_client(self, sock: socket.socket, addr):
+    def _submit(self, coro) -> concurrent.futures.Future:
+        # Sending must work even if start() was never called or failed to bind
+        if self._loop is None:
+            self._loop = get_loop()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _serve(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Set before listen() so accepted sockets inherit the larger buffers
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            server_socket.bind(('', TCP_PORT))
+        except OSError:
+            server_socket.close()
+            raise
+        self.server = await asyncio.start_server(self._handle_client, sock=server_socket, backlog=5, limit=STREAM_BUFFER_SIZE)
+
+    async def _shutdown(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        for writer in list(self._clients):
+            writer.close()
+        for ip in list(self._conns):
+            self._drop_connection(ip)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')
         ip = addr[0]
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._clients.add(writer)
         try:
             while self.running:
-                # Read length prefix (4 bytes)
-                length_bytes = sock.recv(4)
-                if not length_bytes:
+                # Read frame header (type + length); the reader is buffered, so small frames cost no extra syscalls
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
                     break
                 
-                msg_len = int.from_bytes(length_bytes, byteorder='big')
-                
-                # Read message body
-                data = b''
-                while len(data) < msg_len:
-                    chunk = sock.recv(min(msg_len - len(data), BUFFER_SIZE))
-                    if not chunk:
-                        break
-                    data += chunk
+                frame_type, msg_len = HEADER.unpack(header)
+
+                if frame_type == FRAME_FILE_DATA:
+                    # Raw file bytes skip JSON entirely and go straight to disk
+                    await self._receive_file_data(reader, addr, msg_len)
+                    continue
+
+                # Reject bad headers before buffering anything (e.g. a stray HTTP probe)
+                if frame_type != FRAME_JSON:
+                    raise ValueError(f"Unknown frame type {frame_type:#x}")
+                if msg_len > MAX_MESSAGE_SIZE:
+                    raise ValueError(f"Message of {msg_len} bytes exceeds {MAX_MESSAGE_SIZE}")
                 
-                if len(data) != msg_len:
-                    break
+                data = await reader.readexactly(msg_len)
 
                 msg = Message.from_bytes(data)
                 msg.sender_ip = ip # Ensure IP is correct from socket
                 
-                if msg.type == MessageType.FILE_DATA:
-                    self._handle_file_data(msg)
+                handler = self._handlers.get(msg.type)
+                if handler:
+                    await handler(msg, addr)
                 else:
                     self.on_message(msg)
 
         except Exception as e:
             self.logger.error(f"Connection error with {ip}: {e}")
         finally:
-            sock.close()
-
-    def _handle_file_data(self, msg: Message):
-        # Basic file handling - in a real app this would be more robust
-        # For now, we assume FILE_OFFER was accepted and we just write data
-        file_name = msg.payload.get('filename')
-        data_chunk = msg.payload.get('data').encode('latin1') # Re-encode binary data if it was JSON stringified
-        
-        # This is a simplified placeholder. 
-        # In a robust implementation, we'd handle file streams separately or use a raw socket mode for files.
-        # Given the JSON protocol, sending large files as JSON strings is inefficient.
-        # A better approach for this specific requirement (simple, robust) might be to open a separate connection for file transfer
-        # or switch to raw bytes after a header.
-        # However, sticking to the plan and protocol for simplicity of the first iteration.
-        pass
-
-    def send_message(self, target_ip: str, message: str):
+            await self._finish_file(addr)
+            self._clients.discard(writer)
+            writer.close()
+
+    # Disk I/O for received files runs in the default executor so a slow disk (e.g. a Pi
+    # SD card) doesn't stall discovery and the other connections sharing the loop
+
+    async def _handle_file_data(self, msg: Message, addr):
+        # A JSON FILE_DATA message announces the raw FILE_DATA frames that follow on this connection
+        filename = os.path.basename(msg.payload['filename'])
+        offer = (msg.sender_ip, filename)
+        filesize = self.accepted_offers.pop(offer, None)
+        if filesize is None:
+            raise ValueError(f"Unsolicited file {filename} from {msg.sender_ip}")
+        out, path = await self._loop.run_in_executor(None, self._open_download, filename)
+        # The size we accepted bounds the transfer, not whatever this header now claims
+        self.active_transfers[addr] = (out, filename, filesize, 0)
+        self.logger.info(f"Receiving {filename} from {msg.sender_ip} into {path}")
+
+    def _open_download(self, filename: str):
+        # Never overwrite: on a name collision save as "name (1).ext", "name (2).ext", ...
+        os.makedirs(self.download_dir, exist_ok=True)
+        stem, ext = os.path.splitext(filename)
+        candidate, n = filename, 0
+        while True:
+            path = os.path.join(self.download_dir, candidate)
+            try:
+                return open(path, 'xb'), path
+            except FileExistsError:
+                n += 1
+                candidate = f"{stem} ({n}){ext}"
+
+    async def _handle_file_end(self, msg: Message, addr):
+        await self._finish_file(addr)
+        self.on_message(msg)
+
+    async def _receive_file_data(self, reader: asyncio.StreamReader, addr, length: int):
+        transfer = self.active_transfers.get(addr)
+        if transfer is None:
+            raise ValueError("File data received without a FILE_DATA header")
+        out, filename, filesize, received = transfer
+        if received + length > filesize:
+            raise ValueError(f"{filename} from {addr[0]} overruns its offered size of {filesize} bytes")
+
+        remaining = length
+        while remaining:
+            chunk = await reader.read(min(remaining, STREAM_BUFFER_SIZE))
+            if not chunk:
+                raise ConnectionError("Connection closed during file transfer")
+            await self._loop.run_in_executor(None, out.write, chunk)
+            remaining -= len(chunk)
+            before, received = received, received + len(chunk)
+            # A single frame can carry the whole file, so report as chunks land, once per
+            # PROGRESS_STEP crossed and on completion
+            if self.on_file_progress and (received // PROGRESS_STEP != before // PROGRESS_STEP or received == filesize):
+                self.on_file_progress(filename, received, filesize)
+        self.active_transfers[addr] = (out, filename, filesize, received)
+
+    async def _finish_file(self, addr):
+        transfer = self.active_transfers.pop(addr, None)
+        if transfer:
+            await self._loop.run_in_executor(None, transfer[0].close)
+
+    async def _handle_file_accept(self, msg: Message, addr):
+        self.on_message(msg)
+        filepath = self.pending_offers.pop((msg.sender_ip, msg.payload['filename']), None)
+        if filepath is None:
+            self.logger.warning(f"Ignoring FILE_ACCEPT for unknown offer from {msg.sender_ip}")
+            return
+
+        async def transfer():
+            try:
+                await self._send_file(msg.sender_ip, filepath)
+            except Exception:
+                pass # Already logged by _send_file
+
+        # Handlers run on the loop thread, so schedule rather than block on the transfer
+        task = self._loop.create_task(transfer())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle_file_reject(self, msg: Message, addr):
+        self.pending_offers.pop((msg.sender_ip, msg.payload['filename']), None)
+        self.on_message(msg)
+
+    def send_message(self, target_ip: str, message: str) -> concurrent.futures.Future:
         msg = Message(
             type=MessageType.TEXT,
             sender_name=self.username,
             sender_ip="", 
             payload={'text': message}
         )
-        self._send_to_peer(target_ip, msg)
+        return self._submit(self._send_to_peer(target_ip, msg))
 
-    def send_file_offer(self, target_ip: str, filepath: str):
+    def send_file_offer(self, target_ip: str, filepath: str) -> concurrent.futures.Future:
         filename = os.path.basename(filepath)
         filesize = os.path.getsize(filepath)
         msg = Message(
@@ -112,18 +237,130 @@ class NetworkManager:
             sender_ip="",
             payload={'filename': filename, 'filesize': filesize}
         )
-        self._send_to_peer(target_ip, msg)
+        self.pending_offers[(target_ip, filename)] = filepath
+        return self._submit(self._send_to_peer(target_ip, msg))
+
+    def accept_file_offer(self, target_ip: str, filename: str, filesize: int) -> concurrent.futures.Future:
+        self.accepted_offers[(target_ip, os.path.basename(filename))] = filesize
+        return self._send_offer_reply(target_ip, MessageType.FILE_ACCEPT, filename)
 
-    def _send_to_peer(self, ip: str, msg: Message):
+    def reject_file_offer(self, target_ip: str, filename: str) -> concurrent.futures.Future:
+        return self._send_offer_reply(target_ip, MessageType.FILE_REJECT, filename)
+
+    def _send_offer_reply(self, target_ip: str, reply_type: MessageType, filename: str) -> concurrent.futures.Future:
+        msg = Message(
+            type=reply_type,
+            sender_name=self.username,
+            sender_ip="",
+            payload={'filename': filename}
+        )
+        return self._submit(self._send_to_peer(target_ip, msg))
+
+    def send_file(self, target_ip: str, filepath: str) -> concurrent.futures.Future:
+        return self._submit(self._send_file(target_ip, filepath))
+
+    async def _send_file(self, target_ip: str, filepath: str) -> None:
+        filename = os.path.basename(filepath)
+        filesize = os.path.getsize(filepath)
+        header = Message(
+            type=MessageType.FILE_DATA,
+            sender_name=self.username,
+            sender_ip="",
+            payload={'filename': filename, 'filesize': filesize}
+        )
+        end = Message(
+            type=MessageType.FILE_END,
+            sender_name=self.username,
+            sender_ip="",
+            payload={'filename': filename}
+        )
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((ip, TCP_PORT))
-            
-            data = msg.to_bytes()
-            length_bytes = len(data).to_bytes(4, byteorder='big')
-            
-            sock.sendall(length_bytes + data)
-            sock.close()
+            _, writer = await self._connect(target_ip)
+            try:
+                writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+                with open(filepath, 'rb') as f:
+                    self._write_frame(writer, FRAME_JSON, header.to_bytes())
+                    offset = 0
+                    while offset < filesize:
+                        count = min(filesize - offset, MAX_FRAME_SIZE)
+                        writer.write(HEADER.pack(FRAME_FILE_DATA, count))
+                        await writer.drain()
+                        # Uses sendfile(2) where available, so the body never enters Python
+                        await self._loop.sendfile(writer.transport, f, offset, count)
+                        offset += count
+                    self._write_frame(writer, FRAME_JSON, end.to_bytes())
+                    await writer.drain()
+            finally:
+                writer.close()
+                await writer.wait_closed()
+        except Exception as e:
+            self.logger.error(f"Failed to send {filename} to {target_ip}: {e}")
+            raise e
+
+    def _write_frame(self, writer: asyncio.StreamWriter, frame_type: int, data: bytes):
+        header = HEADER.pack(frame_type, len(data))
+        if _GATHER_WRITES:
+            # Header and body go out together in one sendmsg, without concatenating them
+            writer.writelines((header, data))
+        else:
+            # Older transports implement writelines as b''.join, which copies the whole
+            # body; two writes avoid that copy
+            writer.write(header)
+            writer.write(data)
+
+    async def _send_to_peer(self, ip: str, msg: Message):
+        data = msg.to_bytes()
+        try:
+            if len(data) > MAX_MESSAGE_SIZE:
+                raise ValueError(f"Message of {len(data)} bytes exceeds {MAX_MESSAGE_SIZE}")
+            # One lock per peer: an unreachable peer only holds up sends to itself
+            lock = self._conn_locks.get(ip)
+            if lock is None:
+                # Created on the loop thread so it binds to the right loop on older Pythons
+                lock = self._conn_locks[ip] = asyncio.Lock()
+            async with lock:
+                writer, pooled = await self._get_connection(ip)
+                try:
+                    self._write_frame(writer, FRAME_JSON, data)
+                    await writer.drain()
+                except OSError:
+                    self._drop_connection(ip)
+                    if not pooled:
+                        raise
+                    # Pooled connection went stale, reconnect once
+                    writer, _ = await self._get_connection(ip)
+                    self._write_frame(writer, FRAME_JSON, data)
+                    await writer.drain()
         except Exception as e:
             self.logger.error(f"Failed to send to {ip}: {e}")
             raise e
+
+    async def _get_connection(self, ip: str) -> Tuple[asyncio.StreamWriter, bool]:
+        # Caller must hold the peer's lock in self._conn_locks. Returns (writer, pooled)
+        conn = self._conns.get(ip)
+        if conn is not None:
+            reader, writer = conn
+            # Peers never write on this connection, so EOF means it was closed
+            if not reader.at_eof() and not writer.is_closing():
+                return writer, True
+            self._drop_connection(ip)
+
+        reader, writer = await self._connect(ip)
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        self._conns[ip] = (reader, writer)
+        return writer, False
+
+    async def _connect(self, ip: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        # Bounded, so a peer that silently drops SYNs fails fast instead of after the kernel's ~2 min
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(ip, TCP_PORT), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Timed out connecting to {ip} after {CONNECT_TIMEOUT:g}s") from None
+
+    def _drop_connection(self, ip: str):
+        conn = self._conns.pop(ip, None)
+        if conn is not None:
+            conn[1].close()
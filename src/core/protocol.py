@@ -1,48 +1,80 @@
-import json
+import os
 import struct
-from enum import Enum
-from dataclasses import dataclass, asdict
-from typing import Any, Dict, Optional
+from enum import IntEnum
+import msgspec
+from typing import Any, Dict, Optional, Union
 
 # Constants
 UDP_PORT = 5000
 TCP_PORT = 5001
 BUFFER_SIZE = 4096
+STREAM_BUFFER_SIZE = 65536  # Userspace read buffer for TCP streams
+SOCKET_BUFFER_SIZE = 2 * 1024 * 1024  # Kernel SO_RCVBUF/SO_SNDBUF for TCP sockets
 BROADCAST_IP = '<broadcast>'
 DISCOVERY_INTERVAL = 2.0  # Seconds
+CONNECT_TIMEOUT = 5.0  # Seconds to wait for a peer to accept a TCP connection
+DOWNLOAD_DIR = os.path.join(os.path.expanduser('~'), 'Downloads')
 
-class MessageType(str, Enum):
-    DISCOVERY = "DISCOVERY"
-    TEXT = "TEXT"
-    FILE_OFFER = "FILE_OFFER"
-    FILE_ACCEPT = "FILE_ACCEPT"
-    FILE_REJECT = "FILE_REJECT"
-    FILE_DATA = "FILE_DATA"
-    FILE_END = "FILE_END"
-
-@dataclass
-class Message:
+# TCP frame header: 1-byte frame type + 4-byte big-endian body length
+HEADER = struct.Struct('>BI')
+FRAME_JSON = 0x00       # Body is a JSON encoded Message
+FRAME_FILE_DATA = 0x01  # Body is raw file bytes for the transfer announced on the connection
+MAX_FRAME_SIZE = 0xFFFFFFFF
+MAX_MESSAGE_SIZE = 1024 * 1024  # Largest accepted FRAME_JSON body; the length prefix is untrusted
+
+# UDP discovery packet: magic(2) | version(1) | name_len(1) | name (UTF-8)
+DISCOVERY_HEADER = struct.Struct('>2sBB')
+DISCOVERY_MAGIC = b'LM'
+DISCOVERY_VERSION = 1
+
+class MessageType(IntEnum):
+    DISCOVERY = 0
+    TEXT = 1
+    FILE_OFFER = 2
+    FILE_ACCEPT = 3
+    FILE_REJECT = 4
+    FILE_DATA = 5
+    FILE_END = 6
+
+class Message(msgspec.Struct):
     type: MessageType
     sender_name: str
     sender_ip: str
-    payload: Dict[str, Any] = None
+    payload: Optional[Dict[str, Any]] = None
 
     def to_json(self) -> str:
-        data = asdict(self)
-        # Convert Enum to string for JSON serialization
-        data['type'] = self.type.value
-        return json.dumps(data)
+        return _encoder.encode(self).decode('utf-8')
+
+    @staticmethod
+    def from_json(json_str: Union[str, bytes, bytearray, memoryview]) -> 'Message':
+        return _decoder.decode(json_str)
+
+    def to_bytes(self) -> bytes:
+        return _encoder.encode(self)
 
     @staticmethod
-    def from_json(json_str: str) -> 'Message':
-        data = json.loads(json_str)
-        data['type'] = MessageType(data['type'])
-        return Message(**data)
+    def from_bytes(data: Union[bytes, bytearray, memoryview]) -> 'Message':
+        return _decoder.decode(data)
+
+_encoder = msgspec.json.Encoder()
+_decoder = msgspec.json.Decoder(Message)
+
+# DISCOVERY broadcasts use a tiny binary frame instead of JSON; TCP messages keep using Message
+class DiscoveryMsg(msgspec.Struct, frozen=True):
+    sender_name: str
 
     def to_bytes(self) -> bytes:
-        json_str = self.to_json()
-        return json_str.encode('utf-8')
+        # name_len is one byte, so long names are cut to 255 bytes (a split character is dropped on decode)
+        name = self.sender_name.encode('utf-8')[:255]
+        return DISCOVERY_HEADER.pack(DISCOVERY_MAGIC, DISCOVERY_VERSION, len(name)) + name
 
     @staticmethod
-    def from_bytes(data: bytes) -> 'Message':
-        return Message.from_json(data.decode('utf-8'))
+    def from_bytes(data: Union[bytes, bytearray, memoryview]) -> Optional['DiscoveryMsg']:
+        # Returns None for packets that are not ours (other apps may share the port)
+        if len(data) < DISCOVERY_HEADER.size:
+            return None
+        magic, version, name_len = DISCOVERY_HEADER.unpack_from(data)
+        if magic != DISCOVERY_MAGIC or version != DISCOVERY_VERSION:
+            return None
+        start = DISCOVERY_HEADER.size
+        return DiscoveryMsg(bytes(data[start:start + name_len]).decode('utf-8', 'ignore'))
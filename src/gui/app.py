@@ -1,30 +1,59 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext, filedialog, messagebox
-import threading
+import logging
+import os
 import queue
-from typing import Optional
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
 
 from ..core.discovery import PeerDiscovery
 from ..core.network import NetworkManager
 from ..core.protocol import Message, MessageType
 
+MAX_BATCH = 50  # Queued calls run per wake-up, so a burst cannot freeze the UI
+
 class GuiApp:
     def __init__(self, root: tk.Tk, username: str):
         self.root = root
         self.username = username
         self.root.title(f"LAN Messenger - {username}")
         self.root.geometry("800x600")
+        self.logger = logging.getLogger("GuiApp")
 
         self.discovery = PeerDiscovery(username, self.on_peer_discovered, self.on_peer_lost)
         self.network = NetworkManager(username, self.on_message_received)
         self.selected_peer_ip: Optional[str] = None
-        
-        # Queue for thread-safe UI updates
-        self.gui_queue = queue.Queue()
+        self._peer_index: Dict[str, int] = {} # ip -> listbox row
+
+        # (func, args) calls posted by the network thread, run only on the Tk thread.
+        # Tk is never touched from the network thread: root.after there blocks until
+        # the Tk thread services it, which deadlocks against a blocked Tk thread
+        self.gui_queue: queue.SimpleQueue = queue.SimpleQueue()
+        # Latest peer event per ip; flapping peers collapse to one update per wake-up
+        self._pending_peers: Dict[str, Tuple[str, str]] = {} # ip -> (name, 'add' | 'del')
+        self._pending_lock = threading.Lock()
+
+        # Self-pipe: a byte written by the network thread wakes Tk's event loop through a
+        # file handler, so events are applied immediately without polling or calling into Tcl
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._wake_pending = False # a wake byte is in flight; guarded by _pending_lock
+        self._draining = False
+        self.root.tk.createfilehandler(self._wake_r, tk.READABLE, self._on_wake)
+
+        # UI handlers per incoming message type, run on the Tk thread
+        self._message_handlers = {
+            MessageType.TEXT: self._handle_text,
+            MessageType.FILE_OFFER: self._handle_file_offer,
+            MessageType.FILE_REJECT: self._handle_file_reject,
+            MessageType.FILE_END: self._handle_file_end,
+        }
 
         self._setup_ui()
-        self._start_services()
-        self._process_queue()
+        # Start once mainloop is running, so early peer events have a consumer
+        self.root.after_idle(self._start_services)
 
     def _setup_ui(self):
         # Main Layout
@@ -64,36 +93,103 @@ class GuiApp:
         self.discovery.start()
         self.network.start()
 
-    def _process_queue(self):
+    def _wake(self):
+        # Safe from any thread; at most one byte is in flight per wake-up. The write stays
+        # under the lock so on_close can't close the pipe out from under it
+        with self._pending_lock:
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+            try:
+                os.write(self._wake_w, b'\0')
+            except BlockingIOError:
+                pass # Pipe full, so a wake-up is already queued
+
+    def _on_wake(self, fd, mask):
         try:
-            while True:
-                task = self.gui_queue.get_nowait()
-                task()
-        except queue.Empty:
+            os.read(fd, 512)
+        except BlockingIOError:
             pass
-        self.root.after(100, self._process_queue)
+        with self._pending_lock:
+            self._wake_pending = False
+        if self._draining:
+            # A handler's modal dialog is spinning a nested event loop; the outer drain
+            # re-wakes when it finishes, which keeps events in order
+            return
+        self._draining = True
+        try:
+            self._process_queue()
+        finally:
+            self._draining = False
+            if self._pending_peers or not self.gui_queue.empty():
+                self._wake()
+
+    def _process_queue(self):
+        with self._pending_lock:
+            pending, self._pending_peers = self._pending_peers, {}
+        for ip, (name, action) in pending.items():
+            if action == 'add':
+                self._run_safely(self._add_peer, ip, name)
+            else:
+                self._run_safely(self._remove_peer, ip)
+
+        # Anything left over past MAX_BATCH is picked up by the re-wake in _on_wake
+        for _ in range(MAX_BATCH):
+            try:
+                func, args = self.gui_queue.get_nowait()
+            except queue.Empty:
+                break
+            self._run_safely(func, *args)
+
+    def _run_safely(self, func, *args):
+        # Handlers act on peer-supplied payloads (e.g. a FILE_OFFER missing 'filesize'),
+        # so a failure is logged and skipped rather than stopping the events behind it
+        try:
+            func(*args)
+        except Exception:
+            self.logger.exception(f"Error handling UI event {getattr(func, '__name__', func)}")
+
+    def _post(self, func, *args):
+        # Safe from any thread; never blocks
+        self.gui_queue.put((func, args))
+        self._wake()
+
+    def _report_failure(self, what: str):
+        # Done-callback for network futures; reports errors back on the Tk thread
+        def callback(fut: Future):
+            if not fut.cancelled() and fut.exception() is not None:
+                self._post(messagebox.showerror, "Error", f"{what}: {fut.exception()}")
+        return callback
 
     def on_peer_discovered(self, ip: str, name: str):
-        self.gui_queue.put(lambda: self._add_peer(ip, name))
+        with self._pending_lock:
+            self._pending_peers[ip] = (name, 'add')
+        self._wake()
 
     def _add_peer(self, ip: str, name: str):
-        display = f"{name} ({ip})"
         # Check if already exists to avoid duplicates (though discovery handles this logic mostly)
-        if display not in self.peer_listbox.get(0, tk.END):
-            self.peer_listbox.insert(tk.END, display)
+        if ip in self._peer_index:
+            return
+        self._peer_index[ip] = self.peer_listbox.size()
+        self.peer_listbox.insert(tk.END, f"{name} ({ip})")
 
     def on_peer_lost(self, ip: str):
-        self.gui_queue.put(lambda: self._remove_peer(ip))
+        with self._pending_lock:
+            self._pending_peers[ip] = ("", 'del')
+        self._wake()
 
     def _remove_peer(self, ip: str):
-        # Find and remove
-        for idx, item in enumerate(self.peer_listbox.get(0, tk.END)):
-            if f"({ip})" in item:
-                self.peer_listbox.delete(idx)
-                if self.selected_peer_ip == ip:
-                    self.selected_peer_ip = None
-                    self._log_message("System", f"Peer {ip} lost.")
-                break
+        idx = self._peer_index.pop(ip, None)
+        if idx is None:
+            return
+        self.peer_listbox.delete(idx)
+        # Rows below the removed one shift up by one
+        for peer_ip, row in self._peer_index.items():
+            if row > idx:
+                self._peer_index[peer_ip] = row - 1
+        if self.selected_peer_ip == ip:
+            self.selected_peer_ip = None
+            self._log_message("System", f"Peer {ip} lost.")
 
     def _on_peer_selected(self, event):
         selection = self.peer_listbox.curselection()
@@ -104,20 +200,30 @@ class GuiApp:
             self._log_message("System", f"Selected peer: {self.selected_peer_ip}")
 
     def on_message_received(self, msg: Message):
-        if msg.type == MessageType.TEXT:
-            self.gui_queue.put(lambda: self._log_message(msg.sender_name, msg.payload['text']))
-        elif msg.type == MessageType.FILE_OFFER:
-            self.gui_queue.put(lambda: self._handle_file_offer(msg))
+        handler = self._message_handlers.get(msg.type)
+        if handler:
+            self._post(handler, msg)
+
+    def _handle_text(self, msg: Message):
+        self._log_message(msg.sender_name, msg.payload['text'])
+
+    def _handle_file_reject(self, msg: Message):
+        self._log_message("System", f"{msg.sender_name} rejected {msg.payload['filename']}")
+
+    def _handle_file_end(self, msg: Message):
+        self._log_message("System", f"Received {msg.payload['filename']} from {msg.sender_name}")
 
     def _handle_file_offer(self, msg: Message):
         filename = msg.payload['filename']
         size = msg.payload['filesize']
-        if messagebox.askyesno("File Offer", f"{msg.sender_name} wants to send {filename} ({size} bytes). Accept?"):
-            # In a real app, we'd send FILE_ACCEPT and start transfer.
-            # For this simplified version, we'll just log it.
-            self._log_message("System", f"Accepted file offer for {filename} (Not fully implemented)")
+        accepted = messagebox.askyesno("File Offer", f"{msg.sender_name} wants to send {filename} ({size} bytes). Accept?")
+        if accepted:
+            fut = self.network.accept_file_offer(msg.sender_ip, filename, size)
+            self._log_message("System", f"Accepted file offer for {filename}, saving to {self.network.download_dir}")
         else:
+            fut = self.network.reject_file_offer(msg.sender_ip, filename)
             self._log_message("System", f"Rejected file offer for {filename}")
+        fut.add_done_callback(self._report_failure("Failed to answer file offer"))
 
     def _send_message(self):
         text = self.msg_entry.get()
@@ -128,12 +234,10 @@ class GuiApp:
             messagebox.showerror("Error", "Select a peer first.")
             return
 
-        try:
-            self.network.send_message(self.selected_peer_ip, text)
-            self._log_message(self.username, text)
-            self.msg_entry.delete(0, tk.END)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to send: {e}")
+        fut = self.network.send_message(self.selected_peer_ip, text)
+        fut.add_done_callback(self._report_failure("Failed to send"))
+        self._log_message(self.username, text)
+        self.msg_entry.delete(0, tk.END)
 
     def _send_file(self):
         if not self.selected_peer_ip:
@@ -143,10 +247,13 @@ class GuiApp:
         filepath = filedialog.askopenfilename()
         if filepath:
             try:
-                self.network.send_file_offer(self.selected_peer_ip, filepath)
-                self._log_message("System", f"Sent file offer: {filepath}")
-            except Exception as e:
+                # getsize runs here, so an unreadable file fails before any future exists
+                fut = self.network.send_file_offer(self.selected_peer_ip, filepath)
+            except OSError as e:
                 messagebox.showerror("Error", f"Failed to send file offer: {e}")
+                return
+            fut.add_done_callback(self._report_failure("Failed to send file offer"))
+            self._log_message("System", f"Sent file offer: {filepath}")
 
     def _log_message(self, sender: str, text: str):
         self.chat_display.configure(state='normal')
@@ -157,6 +264,11 @@ class GuiApp:
     def on_close(self):
         self.discovery.stop()
         self.network.stop()
+        self.root.tk.deletefilehandler(self._wake_r)
+        with self._pending_lock:
+            self._wake_pending = True # Late network callbacks never write again
+            os.close(self._wake_r)
+            os.close(self._wake_w)
         self.root.destroy()
 
 def run_gui(username: str):
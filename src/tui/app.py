@@ -6,11 +6,21 @@ from textual import work
 from datetime import datetime
 import threading
 import asyncio
+from typing import Dict
 
 from ..core.discovery import PeerDiscovery
 from ..core.network import NetworkManager
 from ..core.protocol import Message, MessageType
 
+class NetworkEvent(TextualMessage):
+    # A UI update handed over from the network thread. Unlike call_from_thread,
+    # post_message queues it without waiting, so the network loop never blocks on the UI.
+    def __init__(self, callback, *args, **kwargs):
+        super().__init__()
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+
 class ChatMessage(ListItem):
     def __init__(self, sender: str, text: str, is_self: bool):
         super().__init__()
@@ -58,6 +68,11 @@ class TuiApp(App):
         self.discovery = PeerDiscovery(username, self.on_peer_discovered, self.on_peer_lost)
         self.network = NetworkManager(username, self.on_message_received)
         self.selected_peer_ip = None
+        self._peer_items: Dict[str, PeerItem] = {} # ip -> list entry
+        # UI handlers per incoming message type, run on the app thread
+        self._message_handlers = {
+            MessageType.TEXT: self._handle_text,
+        }
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -79,26 +94,34 @@ class TuiApp(App):
         self.discovery.stop()
         self.network.stop()
 
+    def on_network_event(self, event: NetworkEvent):
+        event.callback(*event.args, **event.kwargs)
+
     def on_peer_discovered(self, ip: str, name: str):
-        self.call_from_thread(self._add_peer, ip, name)
+        self.post_message(NetworkEvent(self._add_peer, ip, name))
 
     def _add_peer(self, ip: str, name: str):
-        peer_list = self.query_one("#peer-list", ListView)
-        peer_list.append(PeerItem(ip, name))
+        if ip in self._peer_items:
+            return
+        item = PeerItem(ip, name)
+        self._peer_items[ip] = item
+        self.query_one("#peer-list", ListView).append(item)
 
     def on_peer_lost(self, ip: str):
-        self.call_from_thread(self._remove_peer, ip)
+        self.post_message(NetworkEvent(self._remove_peer, ip))
 
     def _remove_peer(self, ip: str):
-        peer_list = self.query_one("#peer-list", ListView)
-        for item in peer_list.children:
-            if isinstance(item, PeerItem) and item.ip == ip:
-                item.remove()
-                break
+        item = self._peer_items.pop(ip, None)
+        if item is not None:
+            item.remove()
 
     def on_message_received(self, msg: Message):
-        if msg.type == MessageType.TEXT:
-            self.call_from_thread(self._add_message, msg.sender_name, msg.payload['text'], False)
+        handler = self._message_handlers.get(msg.type)
+        if handler:
+            self.post_message(NetworkEvent(handler, msg))
+
+    def _handle_text(self, msg: Message):
+        self._add_message(msg.sender_name, msg.payload['text'], False)
 
     def _add_message(self, sender: str, text: str, is_self: bool):
         messages = self.query_one("#messages", ListView)
@@ -129,12 +152,15 @@ class TuiApp(App):
             self.notify("Please select a peer first.", severity="error")
             return
 
-        try:
-            self.network.send_message(self.selected_peer_ip, text)
-            self._add_message(self.username, text, True)
-            input_widget.value = ""
-        except Exception as e:
-            self.notify(f"Failed to send: {e}", severity="error")
+        self.network.send_message(self.selected_peer_ip, text).add_done_callback(self._on_send_done)
+        self._add_message(self.username, text, True)
+        input_widget.value = ""
+
+    def _on_send_done(self, future):
+        # Runs on the network thread
+        error = future.exception()
+        if error is not None:
+            self.post_message(NetworkEvent(self.notify, f"Failed to send: {error}", severity="error"))
 
 if __name__ == "__main__":
     app = TuiApp("User")